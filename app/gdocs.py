@@ -1,28 +1,30 @@
+import functools
 import os
 from datetime import datetime
 
 import pygsheets
 
-TODAY_YYYY_MM_DD = datetime.today().strftime('%Y-%m-%d')
 
+# A cell that isn't linked to any sheet, used as the format template for the header rows. It never changes,
+# so it's only built once.
+@functools.lru_cache(maxsize=1)
+def get_header_format():
+    header_format = pygsheets.Cell('A1')
+    header_format.set_text_format('bold', True)
+    return header_format
 
+
+# Write rows of data to a new worksheet, dated today. The rows are written in the order given, in a single request.
 def write_to_spreadsheet(data):
     spreadsheet = get_sheet()
-    worksheet = spreadsheet.add_worksheet(TODAY_YYYY_MM_DD, index=0)
-    worksheet.update_values(crange='A1', values=[['Last updated: ' + datetime.utcnow().isoformat() + 'Z']])
-    worksheet.update_values(crange='A2', values=data)
+    worksheet = spreadsheet.add_worksheet(datetime.today().strftime('%Y-%m-%d'), index=0)
+    last_updated = ['Last updated: ' + datetime.utcnow().isoformat() + 'Z']
+    worksheet.update_values(crange='A1', values=[last_updated] + data)
 
-    # Make the first two rows frozen & bold
+    # Make the first two rows frozen & bold. Creating the DataRange fetches A1:Z2 once, and the format is then applied
+    # to the whole range in one more request, rather than fetching and updating each cell separately.
     worksheet.frozen_rows = 2
-    header = worksheet.range('A1:Z2')
-    for row in header:
-        for cell in row:
-            cell.set_text_format('bold', True)
-            cell.update()
-
-    # Sort by name, then by price descending
-    worksheet.sort_range('A3', 'Z999', basecolumnindex=1)
-    worksheet.sort_range('A3', 'Z999', basecolumnindex=7, sortorder='DESCENDING')
+    pygsheets.DataRange('A1', 'Z2', worksheet=worksheet).apply_format(get_header_format())
 
     return spreadsheet.url;
 
@@ -5,85 +5,139 @@ __license__ = "MIT"
 import argparse
 import re
 import sys
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from operator import attrgetter
 
 from . import gdocs
 from . import parsing
 from . import sqaws
 from . import sqslack
+from .util import Clock, money_to_string
 
 TERMINATION_WARNING_DAYS = 3
 
-TODAY = datetime.today()
-TODAY_YYYY_MM_DD = TODAY.strftime('%Y-%m-%d')
-TODAY_IS_WEEKEND = TODAY.weekday() >= 4  # Days are 0-6. 4=Friday, 5=Saturday, 6=Sunday, 0=Monday
-YESTERDAY_YYYY_MM_DD = (TODAY - timedelta(days=1)).strftime('%Y-%m-%d')
-MIN_TERMINATION_WARNING_YYYY_MM_DD = (TODAY - timedelta(days=3)).strftime('%Y-%m-%d')
+CHANNEL_PATTERN = re.compile(r'#[A-Za-z0-9-]+')
+
+# Names of whitelisted instances (see is_whitelisted). Add more names as alternatives in this one pattern.
+WHITELIST_PATTERN = re.compile(r'bam::.*bamboo')
+
+# Upper bound on how many instances are stopped or terminated at the same time
+MAX_ACTION_WORKERS = 16
+
+# Upper bound on how many Slack contacts are looked up at the same time
+MAX_SLACK_LOOKUP_WORKERS = 16
+# Listing every Slack user takes several rate-limited requests, so only do it when there are many contacts to find
+SLACK_EMAIL_INDEX_MIN_CONTACTS = 20
+
+# How long notify waits for the Google Sheet to be written before posting the summary without a link to it
+SPREADSHEET_TIMEOUT_SECONDS = 60
+
+# The details that follow make_instance_summary() on each line of the terminate/stop messages
+TERMINATE_DETAILS_TEMPLATE = ', "Terminate after"={}, "Monthly Price"={}, Contact={}\n'
+STOP_DETAILS_TEMPLATE = ', "Stop after"={}, "Monthly Price"={}, Contact={}\n'
+
+INSTANCE_URL_TEMPLATE = 'https://%s.console.aws.amazon.com/ec2/v2/home?region=%s#Instances:search=%s'
 
 """
 PREREQUISITES:
 1. An AWS account with credentials set up in a standard place (environment variables, home directory, etc.)
-2. The AWS credentials must have access to the EC2 APIs "describe_regions" and "describe_instances"
+2. The AWS credentials must have access to the EC2 APIs "describe_regions", "describe_instances" and "describe_volumes"
 3. PIP dependencies specified in requirements.txt.
 4. Environment variable "SLACK_BOT_TOKEN" containing a token allowing messages to be posted to Slack.
 """
 
 
 class Nagbot(object):
-    def notify_internal(self, channel):
-        instances = sqaws.list_ec2_instances()
+    def __init__(self, instance_cache_seconds=0):
+        # How long a cached instance list may be reused by 'notify'. Zero (the default) always queries AWS.
+        self.instance_cache_seconds = instance_cache_seconds
 
-        num_running_instances = sum(1 for i in instances if i.state == 'running')
-        num_total_instances = sum(1 for i in instances)
-        running_monthly_cost = money_to_string(sum(i.monthly_price for i in instances))
 
-        summary_msg = "Hi, I'm Nagbot v{} :wink: My job is to make sure we don't forget about unwanted AWS servers and waste money!\n".format(__version__)
-        summary_msg += "We have {} running EC2 instances right now and {} total.\n".format(num_running_instances,
-                                                                                                num_total_instances)
-        summary_msg += "If we continue to run these instances all month, it would cost {}.\n" \
-            .format(running_monthly_cost)
+    def notify_internal(self, channel):
+        clock = Clock.now()
+        if self.instance_cache_seconds > 0:
+            instances = sqaws.list_ec2_instances_cached(self.instance_cache_seconds)
+        else:
+            instances = sqaws.list_ec2_instances()
+
+        # Writing the Google Sheet is slow and nothing else depends on it, so do it in the background
+        spreadsheet_executor = ThreadPoolExecutor(max_workers=1)
+        spreadsheet_future = spreadsheet_executor.submit(write_instances_to_spreadsheet, instances)
+        spreadsheet_executor.shutdown(wait=False)
+
+        # Tally up and classify the instances in a single pass.
+        # Whitelisted instances count towards the totals, but are never recommended to stop/terminate.
+        num_running_instances = 0
+        num_total_instances = len(instances)
+        monthly_cost = 0
+        instances_to_terminate = []
+        instances_to_stop = []
+        for i in sorted(instances, key=attrgetter('name')):
+            if i.state == 'running':
+                num_running_instances += 1
+            monthly_cost += i.monthly_price
+            if is_whitelisted(i):
+                continue
+            if is_terminatable(i, clock):
+                instances_to_terminate.append(i)
+            elif is_stoppable(i, clock):
+                instances_to_stop.append(i)
+        running_monthly_cost = money_to_string(monthly_cost)
+
+        contacts = lookup_contacts(instances_to_terminate + instances_to_stop)
+
+        summary_parts = [
+            "Hi, I'm Nagbot v{} :wink: My job is to make sure we don't forget about unwanted AWS servers and waste money!\n".format(__version__),
+            "We have {} running EC2 instances right now and {} total.\n".format(num_running_instances,
+                                                                                 num_total_instances),
+            "If we continue to run these instances all month, it would cost {}.\n".format(running_monthly_cost)]
 
-        # Collect all of the data to a Google Sheet
         try:
-            header = instances[0].to_header()
-            body = [i.to_list() for i in instances]
-            spreadsheet_url = gdocs.write_to_spreadsheet([header] + body)
-            summary_msg += '\nIf you want to see all the details, I wrote them to a spreadsheet at ' + spreadsheet_url
+            spreadsheet_url = spreadsheet_future.result(timeout=SPREADSHEET_TIMEOUT_SECONDS)
+            summary_parts.append('\nIf you want to see all the details, I wrote them to a spreadsheet at ' + spreadsheet_url)
             print('Wrote data to Google sheet at URL ' + spreadsheet_url)
         except Exception as e:
             print('Failed to write data to Google sheet: ' + str(e))
 
-        sqslack.send_message(channel, summary_msg)
+        sqslack.send_message(channel, ''.join(summary_parts))
 
-        # From here on, exclude "whitelisted" instances
-        all_instances = instances
-        instances = sorted((i for i in instances if not is_whitelisted(i)), key=lambda i: i.name)
+        tag_updates = []
 
-        instances_to_terminate = get_terminatable_instances(instances)
         if len(instances_to_terminate) > 0:
-            terminate_msg = 'The following %d _stopped_ instances are due to be *TERMINATED*, based on the "Terminate after" tag:\n' % len(instances_to_terminate)
+            terminate_parts = ['The following %d _stopped_ instances are due to be *TERMINATED*, based on the "Terminate after" tag:\n' % len(instances_to_terminate)]
             for i in instances_to_terminate:
-                contact = sqslack.lookup_user_by_email(i.contact)
-                terminate_msg += make_instance_summary(i) + ', "Terminate after"={}, "Monthly Price"={}, Contact={}\n' \
-                    .format(i.terminate_after, money_to_string(i.monthly_price), contact)
-                sqaws.set_tag(i.region_name, i.instance_id, 'Terminate after',
-                              parsing.add_warning_to_tag(i.terminate_after, TODAY_YYYY_MM_DD))
+                contact = contacts[i.contact]
+                terminate_parts.append(make_instance_summary(i) + TERMINATE_DETAILS_TEMPLATE
+                                       .format(i.terminate_after, i.monthly_price_string, contact))
+                tag_updates.append((i.region_name, i.instance_id, 'Terminate after',
+                                    parsing.add_warning_to_tag(i.terminate_after, clock.today)))
+            terminate_msg = ''.join(terminate_parts)
         else:
             terminate_msg = 'No instances are due to be terminated at this time.\n'
-        sqslack.send_message(channel, terminate_msg)
 
-        instances_to_stop = get_stoppable_instances(instances)
         if len(instances_to_stop) > 0:
-            stop_msg ='The following %d _running_ instances are due to be *STOPPED*, based on the "Stop after" tag:\n' % len(instances_to_stop)
+            stop_parts = ['The following %d _running_ instances are due to be *STOPPED*, based on the "Stop after" tag:\n' % len(instances_to_stop)]
             for i in instances_to_stop:
-                contact = sqslack.lookup_user_by_email(i.contact)
-                stop_msg += make_instance_summary(i) + ', "Stop after"={}, "Monthly Price"={}, Contact={}\n' \
-                    .format(i.stop_after, money_to_string(i.monthly_price), contact)
-                sqaws.set_tag(i.region_name, i.instance_id, 'Stop after',
-                              parsing.add_warning_to_tag(i.stop_after, TODAY_YYYY_MM_DD, replace=True))
+                contact = contacts[i.contact]
+                stop_parts.append(make_instance_summary(i) + STOP_DETAILS_TEMPLATE
+                                  .format(i.stop_after, i.monthly_price_string, contact))
+                tag_updates.append((i.region_name, i.instance_id, 'Stop after',
+                                    parsing.add_warning_to_tag(i.stop_after, clock.today, replace=True)))
+            stop_msg = ''.join(stop_parts)
         else:
             stop_msg = 'No instances are due to be stopped at this time.\n'
-        sqslack.send_message(channel, stop_msg)
+
+        # Many instances get the same warning tag, so tag them in batches rather than one at a time.
+        # Tagging and posting to Slack don't depend on each other, so do both at the same time.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            tag_future = executor.submit(sqaws.set_tags, tag_updates)
+            if len(instances_to_terminate) == 0 and len(instances_to_stop) == 0:
+                # Nothing to warn about, which is common, so say so once rather than in two messages
+                sqslack.send_message(channel, 'No instances are due to be stopped or terminated at this time.\n')
+            else:
+                sqslack.send_message(channel, terminate_msg)
+                sqslack.send_message(channel, stop_msg)
+            tag_future.result()
 
 
     def notify(self, channel):
@@ -95,38 +149,41 @@ class Nagbot(object):
 
 
     def execute_internal(self, channel):
-        instances = sqaws.list_ec2_instances()
-
-        # Only terminate instances which still meet the criteria for terminating, AND were warned several times
-        instances_to_terminate = get_terminatable_instances(instances)
-        instances_to_terminate = [i for i in instances_to_terminate if is_safe_to_terminate(i)]
-
-        # Only stop instances which still meet the criteria for stopping, AND were warned recently
-        instances_to_stop = get_stoppable_instances(instances)
-        instances_to_stop = [i for i in instances_to_stop if is_safe_to_stop(i)]
-
-        if len(instances_to_terminate) > 0:
-            message = 'I terminated the following instances: '
-            for i in instances_to_terminate:
-                contact = sqslack.lookup_user_by_email(i.contact)
-                message = message + make_instance_summary(i) + ', "Terminate after"={}, "Monthly Price"={}, Contact={}\n' \
-                    .format(i.terminate_after, money_to_string(i.monthly_price), contact)
-                sqaws.terminate_instance(i.region_name, i.instance_id)
-            sqslack.send_message(channel, message)
-        else:
-            sqslack.send_message(channel, 'No instances were terminated today.')
-
-        if len(instances_to_stop) > 0:
-            message = 'I stopped the following instances: '
-            for i in instances_to_stop:
-                contact = sqslack.lookup_user_by_email(i.contact)
-                message = message + make_instance_summary(i) + ', "Stop after"={}, "Monthly Price"={}, Contact={}\n' \
-                    .format(i.stop_after, money_to_string(i.monthly_price), contact)
-                sqaws.stop_instance(i.region_name, i.instance_id)
-                sqaws.set_tag(i.region_name, i.instance_id, 'Nagbot State', 'Stopped on ' + TODAY_YYYY_MM_DD)
-            sqslack.send_message(channel, message)
-        else:
-            sqslack.send_message(channel, 'No instances were stopped today.')
+        clock = Clock.now()
+        # Never use a cached instance list here, since we're about to act on it.
+        # Only the instances that could be acted on are listed; the checks below still decide what's safe.
+        instances = sqaws.list_ec2_instances(actionable_only=True)
+
+        # Only terminate instances which still meet the criteria for terminating, AND were warned several times.
+        # Only stop instances which still meet the criteria for stopping, AND were warned recently.
+        instances_to_terminate = []
+        instances_to_stop = []
+        for i in instances:
+            if is_safe_to_terminate(i, clock):
+                instances_to_terminate.append(i)
+            elif is_safe_to_stop(i, clock):
+                instances_to_stop.append(i)
+
+        contacts = lookup_contacts(instances_to_terminate + instances_to_stop)
+
+        # Terminating and stopping touch different instances (stopped vs. running), so do both at the same time
+        messages = []
+        errors = []
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [executor.submit(execute_terminations, instances_to_terminate, contacts),
+                       executor.submit(execute_stops, instances_to_stop, contacts, clock)]
+            for future in futures:
+                try:
+                    messages.append(future.result())
+                except Exception as e:
+                    errors.append(e)
+
+        # Post one combined report, rather than one Slack message per action. Post it even if one of the passes
+        # failed, so that the actions which did happen are still reported; execute() reports the failure.
+        if len(messages) > 0:
+            sqslack.send_message(channel, ''.join(messages))
+        if len(errors) > 0:
+            raise errors[0]
 
 
     def execute(self, channel):
@@ -137,70 +194,125 @@ class Nagbot(object):
             raise(e)
 
 
-def get_stoppable_instances(instances):
-    return list(i for i in instances if is_stoppable(i))
+# Collect all of the data to a Google Sheet, and return its URL
+def write_instances_to_spreadsheet(instances):
+    # The header is a shared tuple, but pygsheets only accepts a list of lists
+    header = list(instances[0].to_header())
+    # Most expensive first, then by name. Sorting here saves two sort requests to Google Sheets.
+    body = [i.to_list() for i in sorted(instances, key=lambda i: (-i.monthly_price, i.name))]
+    return gdocs.write_to_spreadsheet([header] + body)
+
+
+# Look up the Slack user for each instance's contact. With many contacts, listing all Slack users once is cheaper
+# than a lookup per contact, so that's tried first. Otherwise (or if it fails), each distinct contact is looked up on
+# its own, in parallel.
+def lookup_contacts(instances):
+    emails = list({i.contact for i in instances})
+    if len(emails) == 0:
+        return {}
+
+    if len(emails) >= SLACK_EMAIL_INDEX_MIN_CONTACTS:
+        try:
+            email_index = sqslack.build_email_index()
+            return {email: email_index.get(email.lower(), email) for email in emails}
+        except Exception as e:
+            print('Failed to list Slack users, looking up contacts one at a time: ' + str(e))
+
+    with ThreadPoolExecutor(max_workers=MAX_SLACK_LOOKUP_WORKERS) as executor:
+        return dict(zip(emails, executor.map(sqslack.lookup_user_by_email, emails)))
+
+
+# Terminate the given instances, and return a Slack message describing what was done
+def execute_terminations(instances_to_terminate, contacts):
+    if len(instances_to_terminate) == 0:
+        return 'No instances were terminated today.\n'
 
+    message_parts = ['I terminated the following instances: ']
+    for i in instances_to_terminate:
+        contact = contacts[i.contact]
+        message_parts.append(make_instance_summary(i) + TERMINATE_DETAILS_TEMPLATE
+                             .format(i.terminate_after, i.monthly_price_string, contact))
 
-def is_stoppable(instance):
-    parsed_date: parsing.ParsedDate = parsing.parse_date_tag(instance.stop_after)
+    # Each termination is a separate round-trip, so make several at once
+    with ThreadPoolExecutor(max_workers=MAX_ACTION_WORKERS) as executor:
+        list(executor.map(lambda i: sqaws.terminate_instance(i.region_name, i.instance_id), instances_to_terminate))
+    return ''.join(message_parts)
 
-    return instance.state == 'running' and (
-            (parsed_date.expiry_date is None) # Treat unspecified "Stop after" dates as being in the past
-            or (TODAY_IS_WEEKEND and parsed_date.on_weekends) \
-            or (TODAY_YYYY_MM_DD >= parsed_date.expiry_date))
 
+# Stop the given instances, and return a Slack message describing what was done
+def execute_stops(instances_to_stop, contacts, clock: Clock):
+    if len(instances_to_stop) == 0:
+        return 'No instances were stopped today.\n'
 
-def get_terminatable_instances(instances):
-    return list(i for i in instances if is_terminatable(i))
+    message_parts = ['I stopped the following instances: ']
+    for i in instances_to_stop:
+        contact = contacts[i.contact]
+        message_parts.append(make_instance_summary(i) + STOP_DETAILS_TEMPLATE
+                             .format(i.stop_after, i.monthly_price_string, contact))
 
+    # Like terminations, stop several instances at once
+    with ThreadPoolExecutor(max_workers=MAX_ACTION_WORKERS) as executor:
+        list(executor.map(lambda i: sqaws.stop_instance(i.region_name, i.instance_id), instances_to_stop))
 
-def is_terminatable(instance):
-    parsed_date: parsing.ParsedDate = parsing.parse_date_tag(instance.terminate_after)
+    # Every stopped instance gets the same tag, so they can be tagged in batches. The instances are already stopped,
+    # so a tagging failure is added to the report rather than losing it.
+    try:
+        sqaws.set_tags([(i.region_name, i.instance_id, 'Nagbot State', 'Stopped on ' + clock.today_yyyy_mm_dd)
+                        for i in instances_to_stop])
+    except Exception as e:
+        message_parts.append('Failed to tag the stopped instances: ' + str(e) + '\n')
+    return ''.join(message_parts)
+
+
+def is_stoppable(instance, clock: Clock):
+    # Check the state first, so the tag is only parsed for instances that could be stopped
+    if instance.state != 'running':
+        return False
+    parsed_date: parsing.ParsedDate = instance.parsed_stop_after
+
+    return ((parsed_date.expiry_date is None)  # Treat unspecified "Stop after" dates as being in the past
+            or (clock.is_weekend and parsed_date.on_weekends)
+            or (clock.today >= parsed_date.expiry_date))
+
+
+def is_terminatable(instance, clock: Clock):
+    # Check the state first, so the tag is only parsed for instances that could be terminated
+    if instance.state != 'stopped':
+        return False
+    parsed_date: parsing.ParsedDate = instance.parsed_terminate_after
 
     # For now, we'll only terminate instances which have an explicit 'Terminate after' tag
-    return instance.state == 'stopped' and (
-            (parsed_date.expiry_date is not None and TODAY_YYYY_MM_DD >= parsed_date.expiry_date))
+    return parsed_date.expiry_date is not None and clock.today >= parsed_date.expiry_date
 
 
 # Some instances are whitelisted from stop or terminate actions. These won't show up as recommended to stop/terminate.
 def is_whitelisted(instance):
-    for regex in [r'bam::.*bamboo']:
-        if re.fullmatch(regex, instance.name) is not None:
-            return True
-    return False
+    return WHITELIST_PATTERN.fullmatch(instance.name) is not None
 
 
-# Convert floating point dollars to a readable string
-def money_to_string(str):
-    return '${:.2f}'.format(str)
+def is_safe_to_stop(instance, clock: Clock):
+    return is_stoppable(instance, clock) \
+           and instance.parsed_stop_after.warning_date is not None \
+           and instance.parsed_stop_after.warning_date <= clock.today
 
 
-def is_safe_to_stop(instance):
-    warning_date = parsing.parse_date_tag(instance.stop_after).warning_date
-    return is_stoppable(instance) \
-           and warning_date is not None and warning_date <= TODAY_YYYY_MM_DD;
-
-
-def is_safe_to_terminate(instance):
-    warning_date = parsing.parse_date_tag(instance.terminate_after).warning_date
-    return is_terminatable(instance) \
-           and warning_date is not None and warning_date <= MIN_TERMINATION_WARNING_YYYY_MM_DD;
+def is_safe_to_terminate(instance, clock: Clock):
+    return is_terminatable(instance, clock) \
+           and instance.parsed_terminate_after.warning_date is not None \
+           and instance.parsed_terminate_after.warning_date <= clock.days_ago(TERMINATION_WARNING_DAYS)
 
 
 def make_instance_summary(instance):
-    instance_id = instance.instance_id
-    instance_url = url_from_instance_id(instance.region_name, instance_id)
-    link = '<{}|{}>'.format(instance_url, instance.name)
+    link = f'<{url_from_instance_id(instance.region_name, instance.instance_id)}|{instance.name}>'
     if instance.reason:
-        state = 'State=({}, "{}")'.format(instance.state, instance.reason)
+        state = f'State=({instance.state}, "{instance.reason}")'
     else:
-        state = 'State={}'.format(instance.state)
-    line = '{}, {}, Type={}'.format(link, state, instance.instance_type)
-    return line
+        state = f'State={instance.state}'
+    return f'{link}, {state}, Type={instance.instance_type}'
 
 
 def url_from_instance_id(region_name, instance_id):
-    return 'https://{}.console.aws.amazon.com/ec2/v2/home?region={}#Instances:search={}'.format(region_name, region_name, instance_id)
+    return INSTANCE_URL_TEMPLATE % (region_name, region_name, instance_id)
 
 
 def main(args):
@@ -210,12 +322,12 @@ def main(args):
     channel = args.channel
     mode = args.mode
 
-    if re.fullmatch(r'#[A-Za-z0-9-]+', channel) is None:
+    if CHANNEL_PATTERN.fullmatch(channel) is None:
         print('Unexpected channel format "%s", should look like #random or #testing' % channel)
         sys.exit(1)
     print('Destination Slack channel is: ' + channel)
 
-    nagbot = Nagbot()
+    nagbot = Nagbot(instance_cache_seconds=args.instance_cache_seconds)
 
     if mode.lower() == 'notify':
         nagbot.notify(channel)
@@ -240,5 +352,12 @@ if __name__ == "__main__":
         default='#nagbot-testing',
         help="Which Slack channel to publish to")
 
+    parser.add_argument(
+        "--instance-cache-seconds",
+        type=int,
+        default=0,
+        help="For development: in 'notify' mode, reuse the EC2 instance list from a previous run "
+        "if it is younger than this many seconds. Never used in 'execute' mode.")
+
     args = parser.parse_args()
     main(args)
@@ -1,65 +1,78 @@
-import re
+import dataclasses
+import functools
 from dataclasses import dataclass
-from datetime import datetime
+from datetime import date, datetime
 
-
-# Return a datetime.datetime formatted date, or None if the string is not a date
-def parse_date(str: str) -> datetime:
-    try:
-        return datetime.strptime(str, '%Y-%m-%d')
-    except:
-        return None
+# The parts of a date tag like '2019-12-31 (Nagbot: Warned on 2019-12-25)' or 'On Weekends'
+ON_WEEKENDS_PREFIX = 'on weekends'
+WARNING_PREFIX = '(Nagbot: Warned on '
+YYYY_MM_DD_LENGTH = len('2019-12-31')
 
 
-# Take a datetime.datetime and return a string in the appropriate format
-def date_to_string(datetime: datetime) -> str:
-    if datetime is None:
-        return None
-    return datetime.strftime('%Y-%m-%d')
-
-
-@dataclass
+# Frozen, because parse_date_tag() hands out the same cached object to every caller
+@dataclass(frozen=True)
 class ParsedDate:
-    expiry_date: str   # Looks like: 2019-12-31
+    expiry_date: date   # Printed like: 2019-12-31
     on_weekends: bool
-    warning_date: str  # Looks like: 2019-12-31
+    warning_date: date  # Printed like: 2019-12-31
 
     def __str__(self) -> str:
         if self.on_weekends:
             result = 'On Weekends'
         elif self.expiry_date is not None:
-            result = self.expiry_date
+            result = self.expiry_date.isoformat()
         else:
             result = '';
 
         if self.warning_date is not None:
-            result += ' (Nagbot: Warned on ' + self.warning_date + ')'
+            result += ' (Nagbot: Warned on ' + self.warning_date.isoformat() + ')'
         return result
 
 
 
-def parse_date_tag(date_tag: str) -> ParsedDate:
-    parsed_date = ParsedDate(None, False, None)
+# Return a datetime.datetime formatted date, or None if the string is not a date
+def parse_date(str: str) -> datetime:
+    try:
+        return datetime.strptime(str, '%Y-%m-%d')
+    except:
+        return None
 
-    match = re.match(r'^(\d{4}-\d{2}-\d{2})', date_tag)
-    if match:
-        expiry_date = datetime.strptime(match.group(1), '%Y-%m-%d')
-        parsed_date.expiry_date = date_to_string(expiry_date)
 
-    match = re.match(r'^On Weekends', date_tag, re.IGNORECASE)
-    if match:
-        parsed_date.on_weekends = True
+# Take a datetime.datetime and return a string in the appropriate format
+def date_to_string(datetime: datetime) -> str:
+    if datetime is None:
+        return None
+    return datetime.strftime('%Y-%m-%d')
+
+
+# Return a datetime.date for a YYYY-MM-DD string, or None if the string is not a valid date
+def parse_yyyy_mm_dd(str: str) -> date:
+    if len(str) != YYYY_MM_DD_LENGTH or str[4] != '-' or str[7] != '-':
+        return None
+    try:
+        return date.fromisoformat(str)
+    except ValueError:
+        return None
+
+
+# Many instances share the same tag values (e.g. '' or 'On Weekends'), so cache the results
+@functools.lru_cache(maxsize=8192)
+def parse_date_tag(date_tag: str) -> ParsedDate:
+    # These are simple fixed-position checks, so they're done with string operations rather than regexes
+    expiry_date = parse_yyyy_mm_dd(date_tag[:YYYY_MM_DD_LENGTH])
+    on_weekends = date_tag[:len(ON_WEEKENDS_PREFIX)].lower() == ON_WEEKENDS_PREFIX
 
-    match = re.match(r'.*\(Nagbot: Warned on (\d{4}-\d{2}-\d{2})\)$', date_tag)
-    if match:
-        warning_date = datetime.strptime(match.group(1), '%Y-%m-%d')
-        parsed_date.warning_date = date_to_string(warning_date)
+    # The warning is always last, like: (Nagbot: Warned on 2019-12-25)
+    warning_date = None
+    warning_start = len(date_tag) - len(WARNING_PREFIX) - YYYY_MM_DD_LENGTH - 1
+    if warning_start >= 0 and date_tag.endswith(')') and date_tag.startswith(WARNING_PREFIX, warning_start):
+        warning_date = parse_yyyy_mm_dd(date_tag[warning_start + len(WARNING_PREFIX):-1])
 
-    return parsed_date
+    return ParsedDate(expiry_date, on_weekends, warning_date)
 
 
-def add_warning_to_tag(old_date_tag: str, warning_date: str, replace=False) -> str:
+def add_warning_to_tag(old_date_tag: str, warning_date: date, replace=False) -> str:
     parsed_date = parse_date_tag(old_date_tag)
     if parsed_date.warning_date is None or replace:
-        parsed_date.warning_date = warning_date
+        parsed_date = dataclasses.replace(parsed_date, warning_date=warning_date)
     return str(parsed_date)
\ No newline at end of file
@@ -1,16 +1,54 @@
+import functools
 import os
+import pickle
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 
 import awspricing
 import boto3
+from botocore.config import Config
+
+from . import parsing
+from .util import money_to_string
 
 os.environ['AWSPRICING_USE_CACHE'] = '1'
 HOURS_IN_A_MONTH = 730
 
+# The only tags that Nagbot reads. Instances can have dozens of other tags, which we skip.
+KNOWN_TAG_KEYS = frozenset(['Name', 'Contact', 'Nagbot State',
+                            'Stop after', 'Stop After', 'StopAfter',
+                            'Terminate after', 'Terminate After', 'TerminateAfter'])
+
+# Instance states that are worth reporting on, i.e. everything except shutting-down and terminated
+LIVE_INSTANCE_STATES = ['pending', 'running', 'stopping', 'stopped']
+
+# Only instances in these states, with one of these tags, can be stopped or terminated by 'execute'
+ACTIONABLE_INSTANCE_STATES = ['running', 'stopped']
+ACTIONABLE_TAG_KEYS = ['Stop after', 'Stop After', 'StopAfter', 'Terminate after', 'Terminate After', 'TerminateAfter']
+
+# Where list_ec2_instances_cached() keeps its results
+CACHE_DIR = os.path.expanduser('~/.cache/nagbot')
+
+# The most resources that a single EC2 create_tags call accepts
+CREATE_TAGS_MAX_RESOURCES = 1000
+
+# Upper bound on how many create_tags calls run at the same time
+MAX_TAG_WORKERS = 10
 
-# Convert floating point dollars to a readable string
-def money_to_string(str):
-    return '${:.2f}'.format(str)
+# Upper bound on how many AWS list calls (across all regions) run at the same time
+MAX_LIST_WORKERS = 20
+
+# Adaptive retries back off client-side when AWS throttles us, instead of failing a whole region.
+# The default pool of 10 connections would make concurrent calls on a shared client wait for each other.
+# The default 60 second timeouts would let one unresponsive region hold up the whole run for minutes.
+BOTO_CONFIG = Config(max_pool_connections=50, retries={'mode': 'adaptive', 'max_attempts': 10},
+                     connect_timeout=5, read_timeout=30)
+
+
+# Held while looking up or creating EC2 clients, see get_ec2_client()
+EC2_CLIENT_LOCK = threading.Lock()
 
 
 # Quote a string
@@ -18,6 +56,23 @@ def quote(str):
     return '"' + str + '"'
 
 
+# Column names for Instance.to_list(), which never change, so they're built once
+INSTANCE_HEADER = ('Instance ID',
+                   'Name',
+                   'State',
+                   'Stop After',
+                   'Terminate After',
+                   'Contact',
+                   'Nagbot State',
+                   'Monthly Price',
+                   'Monthly Server Price',
+                   'Monthly Storage Price',
+                   'Region Name',
+                   'Instance Type',
+                   'Reason',
+                   'OS')
+
+
 # Model class for an EC2 instance
 @dataclass
 class Instance:
@@ -36,23 +91,24 @@ class Instance:
     monthly_server_price: float
     monthly_storage_price: float
 
-    def to_header(self) -> str:
-        return ['Instance ID',
-                'Name',
-                'State',
-                'Stop After',
-                'Terminate After',
-                'Contact',
-                'Nagbot State',
-                'Monthly Price',
-                'Monthly Server Price',
-                'Monthly Storage Price',
-                'Region Name',
-                'Instance Type',
-                'Reason',
-                'OS']
-
-    def to_list(self) -> str:
+    # The date tags are checked several times per instance, so only parse them once
+    @functools.cached_property
+    def parsed_stop_after(self) -> parsing.ParsedDate:
+        return parsing.parse_date_tag(self.stop_after)
+
+    @functools.cached_property
+    def parsed_terminate_after(self) -> parsing.ParsedDate:
+        return parsing.parse_date_tag(self.terminate_after)
+
+    # The monthly price is shown both in the spreadsheet and in Slack messages, so only format it once
+    @functools.cached_property
+    def monthly_price_string(self) -> str:
+        return money_to_string(self.monthly_price)
+
+    def to_header(self) -> tuple:
+        return INSTANCE_HEADER
+
+    def to_list(self) -> list:
         return [self.instance_id,
                 self.name,
                 self.state,
@@ -60,7 +116,7 @@ class Instance:
                 self.terminate_after,
                 self.contact,
                 self.nagbot_state,
-                money_to_string(self.monthly_price),
+                self.monthly_price_string,
                 money_to_string(self.monthly_server_price),
                 money_to_string(self.monthly_storage_price),
                 self.region_name,
@@ -69,31 +125,95 @@ class Instance:
                 self.operating_system]
 
 
-# Get a list of model classes representing important properties of EC2 instances
-def list_ec2_instances():
-    ec2 = boto3.client('ec2', region_name='us-west-2')
+# Get a list of model classes representing important properties of EC2 instances.
+# With actionable_only, EC2 only returns the instances that 'execute' could act on, rather than the whole fleet.
+def list_ec2_instances(actionable_only=False):
+    if actionable_only:
+        filters = [{'Name': 'instance-state-name', 'Values': ACTIONABLE_INSTANCE_STATES},
+                   {'Name': 'tag-key', 'Values': ACTIONABLE_TAG_KEYS}]
+    else:
+        # Terminated instances linger in the API for a while, but cost nothing and can't be acted on, so skip them
+        filters = [{'Name': 'instance-state-name', 'Values': LIVE_INSTANCE_STATES}]
 
-    describe_regions_response = ec2.describe_regions()
-    instances = []
-    i = 1
+    region_names = get_region_names()
     print('Checking all AWS regions...')
-    for region in describe_regions_response['Regions']:
-        print('region = ' + str(region))
-        region_name = region['RegionName']
-        ec2 = boto3.client('ec2', region_name=region_name)
-        describe_instances_response = ec2.describe_instances()
-        for reservation in describe_instances_response['Reservations']:
-            for instance_dict in reservation['Instances']:
-                instance = build_instance_model(region_name, instance_dict)
-                instances.append(instance)
-                print(str(i) + ': ' + str(instance))
-                i += 1
+
+    # Load the pricing data up front, rather than in every thread at once
+    get_ec2_offer()
+
+    # Each region's client is cached by get_ec2_client(), so later listings and actions in the same run reuse them
+    regional_clients = [get_ec2_client(region_name) for region_name in region_names]
+
+    # Each region is a separate network round-trip, so query all of them at once rather than one after another.
+    # Instances and volumes are separate calls too, and don't depend on each other, so list both at the same time.
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_LIST_WORKERS, 2 * len(region_names)))) as executor:
+        instance_dicts_futures = [executor.submit(describe_instances_in_region, region_name, ec2, filters)
+                                  for region_name, ec2 in zip(region_names, regional_clients)]
+        volume_sizes_futures = [executor.submit(get_ebs_volume_sizes, ec2) for ec2 in regional_clients]
+
+        instances = []
+        for region_name, instance_dicts_future, volume_sizes_future \
+                in zip(region_names, instance_dicts_futures, volume_sizes_futures):
+            volume_sizes = volume_sizes_future.result()
+            instances.extend(build_instance_model(region_name, instance_dict, volume_sizes)
+                             for instance_dict in instance_dicts_future.result())
+
+    for i, instance in enumerate(instances, start=1):
+        print(str(i) + ': ' + str(instance))
     return instances
 
 
+# For development: reuse the instance list from a recent run if it's younger than max_age_seconds,
+# rather than querying every region again
+def list_ec2_instances_cached(max_age_seconds: int) -> list:
+    cache_file = os.path.join(CACHE_DIR, 'ec2_instances.pickle')
+    if os.path.exists(cache_file) and time.time() - os.path.getmtime(cache_file) < max_age_seconds:
+        print('Using cached EC2 instances from ' + cache_file)
+        with open(cache_file, 'rb') as f:
+            return pickle.load(f)
+
+    instances = list_ec2_instances()
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(cache_file, 'wb') as f:
+        pickle.dump(instances, f)
+    return instances
+
+
+# Get the names of all the regions to check for instances. This isn't cached: it's only called once per process,
+# since notify and execute each list instances once, and the instance cache replaces the whole listing.
+def get_region_names() -> tuple:
+    ec2 = get_ec2_client('us-west-2')
+    describe_regions_response = ec2.describe_regions()
+    return tuple(region['RegionName'] for region in describe_regions_response['Regions'])
+
+
+# Get the raw describe_instances data for the EC2 instances in a single region
+def describe_instances_in_region(region_name: str, ec2, filters: list) -> list:
+    print('region = ' + region_name)
+    paginator = ec2.get_paginator('describe_instances')
+    instance_dicts = []
+    for page in paginator.paginate(Filters=filters, PaginationConfig={'PageSize': 1000}):
+        for reservation in page['Reservations']:
+            instance_dicts.extend(reservation['Instances'])
+    return instance_dicts
+
+
+# Get the total size (in GB) of the EBS volumes attached to each instance in a region, with one paginated API call
+# rather than one per instance
+def get_ebs_volume_sizes(ec2) -> dict:
+    volume_sizes = dict()
+    paginator = ec2.get_paginator('describe_volumes')
+    for page in paginator.paginate(PaginationConfig={'PageSize': 1000}):
+        for volume in page['Volumes']:
+            for attachment in volume.get('Attachments', []):
+                instance_id = attachment['InstanceId']
+                volume_sizes[instance_id] = volume_sizes.get(instance_id, 0) + volume['Size']
+    return volume_sizes
+
+
 # Get the info about a single EC2 instance
-def build_instance_model(region_name: str, instance_dict: dict) -> Instance:
-    tags = make_tags_dict(instance_dict.get('Tags', []))
+def build_instance_model(region_name: str, instance_dict: dict, volume_sizes: dict) -> Instance:
+    tags = extract_known_tags(instance_dict.get('Tags', []))
 
     instance_id = instance_dict['InstanceId']
     state = instance_dict['State']['Name']
@@ -104,11 +224,11 @@ def build_instance_model(region_name: str, instance_dict: dict) -> Instance:
     operating_system = ('Windows' if platform == 'windows' else 'Linux')
 
     monthly_server_price = lookup_monthly_price(region_name, instance_type, operating_system)
-    monthly_storage_price = estimate_monthly_ebs_storage_price(region_name, instance_dict['InstanceId'])
+    monthly_storage_price = estimate_monthly_ebs_storage_price(volume_sizes.get(instance_id, 0))
     monthly_price = (monthly_server_price + monthly_storage_price) if state == 'running' else monthly_storage_price
 
-    stop_after = tags.get('Stop after', tags.get('Stop After', tags.get('StopAfter', '')))
-    terminate_after = tags.get('Terminate after', tags.get('Terminate After', tags.get('TerminateAfter', '')))
+    stop_after = get_tag(tags, 'Stop after', 'Stop After', 'StopAfter')
+    terminate_after = get_tag(tags, 'Terminate after', 'Terminate After', 'TerminateAfter')
     contact = tags.get('Contact', '')
     nagbot_state = tags.get('Nagbot State', '')
 
@@ -128,33 +248,78 @@ def build_instance_model(region_name: str, instance_dict: dict) -> Instance:
                     nagbot_state=nagbot_state);
 
 
-# Convert the tags list returned from the EC2 API to a dictionary from tag name to tag value
-def make_tags_dict(tags_list: list) -> dict:
-    tags = dict()
-    for tag in tags_list:
-        tags[tag['Key']] = tag['Value']
-    return tags
+# Convert the tags list returned from the EC2 API to a dictionary from tag name to tag value,
+# keeping only the tags that Nagbot reads
+def extract_known_tags(tags_list: list) -> dict:
+    return {tag['Key']: tag['Value'] for tag in tags_list if tag['Key'] in KNOWN_TAG_KEYS}
+
+
+# Get the value of a tag which may be spelled several ways, stopping at the first spelling that is present
+def get_tag(tags: dict, *tag_names: str) -> str:
+    for tag_name in tag_names:
+        value = tags.get(tag_name)
+        if value is not None:
+            return value
+    return ''
+
+
+# Load the EC2 price list. It's large, so only do it once per run.
+@functools.lru_cache(maxsize=1)
+def get_ec2_offer():
+    return awspricing.offer('AmazonEC2')
 
 
-# Use the AWS API to look up the monthly price of an instance, assuming used all month, as hourly, on-demand
+# Use the AWS API to look up the monthly price of an instance, assuming used all month, as hourly, on-demand.
+# Instance types repeat a lot across a fleet, so the results are cached.
+@functools.lru_cache(maxsize=4096)
 def lookup_monthly_price(region_name: str, instance_type: str, operating_system: str) -> float:
-    ec2_offer = awspricing.offer('AmazonEC2')
-    hourly = ec2_offer.ondemand_hourly(instance_type, region=region_name, operating_system=operating_system)
+    hourly = get_ec2_offer().ondemand_hourly(instance_type, region=region_name, operating_system=operating_system)
     return hourly * HOURS_IN_A_MONTH
 
 
 # Estimate the monthly cost of an instance's EBS storage (disk drives)
-def estimate_monthly_ebs_storage_price(region_name: str, instance_id: str) -> float:
-    ec2_resource = boto3.resource('ec2', region_name=region_name)
-    total_gb = sum([v.size for v in ec2_resource.Instance(instance_id).volumes.all()])
+def estimate_monthly_ebs_storage_price(total_gb: int) -> float:
     return total_gb * 0.1 # Assume EBS costs $0.1/GB/month, true as of June 2019 for gp2 type storage
 
 
-# Set a tag on an instance
-def set_tag(region_name: str, instance_id: str, tag_name: str, tag_value: str) -> None:
-    ec2 = boto3.client('ec2', region_name=region_name)
-    print(f'Setting tag {tag_value} on instance: {instance_id} in region {region_name}')
-    response = ec2.create_tags(Resources=[instance_id], Tags=[{
+# Clients are slow to create, so each region's client is only created once and then shared. Using a client from
+# several threads is safe, but creating one from boto3's default session isn't, so the lookup is serialized. That also
+# stops two threads from both missing the cache and creating the same client at once.
+def get_ec2_client(region_name: str):
+    with EC2_CLIENT_LOCK:
+        return create_ec2_client(region_name)
+
+
+# Only call this through get_ec2_client()
+@functools.lru_cache(maxsize=None)
+def create_ec2_client(region_name: str):
+    return boto3.client('ec2', region_name=region_name, config=BOTO_CONFIG)
+
+
+# Set tags on many instances, given as (region_name, instance_id, tag_name, tag_value) tuples. Instances in the same
+# region that get the same tag value are tagged together, with one create_tags call per group (of up to 1000).
+def set_tags(tag_updates: list) -> None:
+    instance_ids_by_tag = dict()
+    for region_name, instance_id, tag_name, tag_value in tag_updates:
+        instance_ids_by_tag.setdefault((region_name, tag_name, tag_value), []).append(instance_id)
+
+    create_tags_calls = []
+    for (region_name, tag_name, tag_value), instance_ids in instance_ids_by_tag.items():
+        ec2 = get_ec2_client(region_name)
+        for start in range(0, len(instance_ids), CREATE_TAGS_MAX_RESOURCES):
+            chunk = instance_ids[start:start + CREATE_TAGS_MAX_RESOURCES]
+            create_tags_calls.append((ec2, region_name, chunk, tag_name, tag_value))
+
+    # Each call is a separate round-trip, so make several at once. Adaptive retries handle any throttling.
+    with ThreadPoolExecutor(max_workers=MAX_TAG_WORKERS) as executor:
+        # list() so that any exception is raised here
+        list(executor.map(lambda args: create_tags(*args), create_tags_calls))
+
+
+# Set one tag on a group of instances in the same region, with a single create_tags call
+def create_tags(ec2, region_name: str, instance_ids: list, tag_name: str, tag_value: str) -> None:
+    print(f'Setting tag {tag_value} on instances: {instance_ids} in region {region_name}')
+    response = ec2.create_tags(Resources=instance_ids, Tags=[{
         'Key': tag_name,
         'Value': tag_value
     }])
@@ -164,7 +329,7 @@ def set_tag(region_name: str, instance_id: str, tag_name: str, tag_value: str) -
 # Stop an EC2 instance
 def stop_instance(region_name: str, instance_id: str) -> bool:
     print(f'Stopping instance: {str(instance_id)}...')
-    ec2 = boto3.client('ec2', region_name=region_name)
+    ec2 = get_ec2_client(region_name)
     try:
         response = ec2.stop_instances(InstanceIds=[instance_id])
         print(f'Response from stop_instances: {str(response)}')
@@ -177,15 +342,11 @@ def stop_instance(region_name: str, instance_id: str) -> bool:
 # Terminate an EC2 instance
 def terminate_instance(region_name: str, instance_id: str) -> bool:
     print(f'Terminating instance: {str(instance_id)}...')
-    ec2 = boto3.client('ec2', region_name=region_name)
+    ec2 = get_ec2_client(region_name)
     try:
         response = ec2.terminate_instances(InstanceIds=[instance_id])
         print(f'Response from terminate_instances: {str(response)}')
         return True
     except Exception as e:
         print(f'Failure when calling terminate_instances: {str(e)}')
-        return False
-
-
-if __name__ == '__main__':
-    main()
\ No newline at end of file
+        return False
\ No newline at end of file
@@ -1,3 +1,4 @@
+import functools
 import os
 
 import slack
@@ -10,6 +11,8 @@ def send_message(channel, message):
     slack_client.chat_postMessage(channel=channel, text=message, as_user=True)
 
 
+# The same person is usually the contact for many instances, so remember who they are for the rest of the run
+@functools.lru_cache(maxsize=1024)
 def lookup_user_by_email(email):
     """ Look up a user by email
     :param email: an email address
@@ -25,6 +28,24 @@ def lookup_user_by_email(email):
         return email
 
 
+def build_email_index():
+    """ List every Slack user once, to look up many emails without a Slack API call per email
+    :return: A dict from lower-cased email address to the user, rendered as an "@user" tag like lookup_user_by_email()
+    """
+    slack_client = get_client()
+    email_index = {}
+    cursor = None
+    while True:
+        result = slack_client.users_list(limit=200, cursor=cursor) if cursor else slack_client.users_list(limit=200)
+        for member in result.data['members']:
+            email = member.get('profile', {}).get('email')
+            if email:
+                email_index[email.lower()] = '<@' + member['id'] + '>'
+        cursor = result.data.get('response_metadata', {}).get('next_cursor')
+        if not cursor:
+            return email_index
+
+
 def get_client():
     slack_bot_token = os.environ['SLACK_BOT_TOKEN']
     return slack.WebClient(token=slack_bot_token)
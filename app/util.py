@@ -0,0 +1,29 @@
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+
+
+# The current date, captured once at the start of a run so that every decision in the run agrees on what day it is,
+# even if the run crosses midnight or the process is long-lived
+@dataclass(frozen=True)
+class Clock:
+    today: date
+    today_yyyy_mm_dd: str
+    is_weekend: bool
+
+    @staticmethod
+    def now():
+        return Clock.for_date(datetime.today().date())
+
+    @staticmethod
+    def for_date(today: date):
+        return Clock(today=today,
+                     today_yyyy_mm_dd=today.isoformat(),
+                     is_weekend=today.weekday() >= 4)  # Days are 0-6. 4=Friday, 5=Saturday, 6=Sunday, 0=Monday
+
+    def days_ago(self, days: int) -> date:
+        return self.today - timedelta(days=days)
+
+
+# Convert floating point dollars to a readable string
+def money_to_string(amount: float) -> str:
+    return '${:.2f}'.format(amount)
@@ -0,0 +1,37 @@
+import unittest
+from unittest.mock import patch
+
+import app.gdocs
+
+
+class TestGdocs(unittest.TestCase):
+    @patch('app.gdocs.get_sheet')
+    @patch('app.gdocs.pygsheets')
+    def test_write_to_spreadsheet(self, mock_pygsheets, mock_get_sheet):
+        app.gdocs.get_header_format.cache_clear()
+        mock_spreadsheet = mock_get_sheet.return_value
+        mock_spreadsheet.url = 'https://docs.google.com/spreadsheets'
+        mock_worksheet = mock_spreadsheet.add_worksheet.return_value
+        data = [['Name', 'Monthly Price'], ['expensive', '$2.00'], ['cheap', '$1.00']]
+
+        assert app.gdocs.write_to_spreadsheet(data) == 'https://docs.google.com/spreadsheets'
+
+        # All of the rows are written in one request, in the order given, after the "Last updated" row
+        mock_worksheet.update_values.assert_called_once()
+        values = mock_worksheet.update_values.call_args.kwargs['values']
+        assert values[0][0].startswith('Last updated: ')
+        assert values[1:] == data
+        assert all(type(row) is list for row in values)
+
+        # The two header rows are frozen, and bolded with a single format request
+        assert mock_worksheet.frozen_rows == 2
+        mock_pygsheets.DataRange.assert_called_once_with('A1', 'Z2', worksheet=mock_worksheet)
+        mock_pygsheets.DataRange.return_value.apply_format.assert_called_once_with(mock_pygsheets.Cell.return_value)
+
+        # The header format is only built once
+        app.gdocs.write_to_spreadsheet(data)
+        mock_pygsheets.Cell.assert_called_once_with('A1')
+
+
+if __name__ == '__main__':
+    unittest.main()
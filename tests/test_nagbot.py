@@ -1,10 +1,13 @@
 import sys
 import unittest
+from datetime import date
+from unittest.mock import patch
 
 import app
 from app import nagbot
 from app import parsing
 from app.sqaws import Instance
+from app.util import Clock
 
 
 class TestNagbot(unittest.TestCase):
@@ -26,12 +29,13 @@ class TestNagbot(unittest.TestCase):
 
 
     def test_stoppable(self):
+        clock = Clock.now()
         past_date = self.setup_instance(state='running', stop_after='2019-01-01')
-        today_date = self.setup_instance(state='running', stop_after=nagbot.TODAY_YYYY_MM_DD)
+        today_date = self.setup_instance(state='running', stop_after=clock.today_yyyy_mm_dd)
 
-        warning_str = ' (Nagbot: Warned on ' + nagbot.TODAY_YYYY_MM_DD + ')'
+        warning_str = ' (Nagbot: Warned on ' + clock.today_yyyy_mm_dd + ')'
         past_date_warned = self.setup_instance(state='running', stop_after='2019-01-01' + warning_str)
-        today_date_warned = self.setup_instance(state='running', stop_after=nagbot.TODAY_YYYY_MM_DD + warning_str)
+        today_date_warned = self.setup_instance(state='running', stop_after=clock.today_yyyy_mm_dd + warning_str)
         anything_warned = self.setup_instance(state='running', stop_after='Yummy Udon Noodles' + warning_str)
 
         wrong_state = self.setup_instance(state='stopped', stop_after='2019-01-01')
@@ -39,40 +43,51 @@ class TestNagbot(unittest.TestCase):
         unknown_date = self.setup_instance(state='running', stop_after='TBD')
 
         # These instances should get a stop warning
-        assert nagbot.is_stoppable(past_date) == True
-        assert nagbot.is_stoppable(today_date) == True
-        assert nagbot.is_stoppable(unknown_date) == True
-        assert nagbot.is_stoppable(past_date_warned) == True
-        assert nagbot.is_stoppable(today_date_warned) == True
-        assert nagbot.is_stoppable(anything_warned) == True
+        assert nagbot.is_stoppable(past_date, clock) == True
+        assert nagbot.is_stoppable(today_date, clock) == True
+        assert nagbot.is_stoppable(unknown_date, clock) == True
+        assert nagbot.is_stoppable(past_date_warned, clock) == True
+        assert nagbot.is_stoppable(today_date_warned, clock) == True
+        assert nagbot.is_stoppable(anything_warned, clock) == True
 
         # These instances should NOT get a stop warning
-        assert nagbot.is_stoppable(wrong_state) == False
-        assert nagbot.is_stoppable(future_date) == False
+        assert nagbot.is_stoppable(wrong_state, clock) == False
+        assert nagbot.is_stoppable(future_date, clock) == False
 
         # These instances don't have a warning, so they shouldn't be stopped yet
-        assert nagbot.is_safe_to_stop(past_date) == False
-        assert nagbot.is_safe_to_stop(today_date) == False
-        assert nagbot.is_safe_to_stop(unknown_date) == False
-        assert nagbot.is_safe_to_stop(wrong_state) == False
-        assert nagbot.is_safe_to_stop(future_date) == False
+        assert nagbot.is_safe_to_stop(past_date, clock) == False
+        assert nagbot.is_safe_to_stop(today_date, clock) == False
+        assert nagbot.is_safe_to_stop(unknown_date, clock) == False
+        assert nagbot.is_safe_to_stop(wrong_state, clock) == False
+        assert nagbot.is_safe_to_stop(future_date, clock) == False
 
         # These instances can be stopped right away
-        assert nagbot.is_safe_to_stop(past_date_warned) == True
-        assert nagbot.is_safe_to_stop(today_date_warned) == True
-        assert nagbot.is_safe_to_stop(anything_warned) == True
+        assert nagbot.is_safe_to_stop(past_date_warned, clock) == True
+        assert nagbot.is_safe_to_stop(today_date_warned, clock) == True
+        assert nagbot.is_safe_to_stop(anything_warned, clock) == True
+
+
+    def test_stoppable_uses_clock(self):
+        instance = self.setup_instance(state='running', stop_after='2019-12-28')
+
+        # The decision depends only on the clock that's passed in
+        assert nagbot.is_stoppable(instance, Clock.for_date(date(2019, 12, 27))) == False
+        assert nagbot.is_stoppable(instance, Clock.for_date(date(2019, 12, 28))) == True
+        assert Clock.for_date(date(2019, 12, 28)).is_weekend == True
+        assert Clock.for_date(date(2019, 12, 30)).is_weekend == False
 
 
     def test_terminatable(self):
+        clock = Clock.now()
         past_date = self.setup_instance(state='stopped', terminate_after='2019-01-01')
-        today_date = self.setup_instance(state='stopped', terminate_after=nagbot.TODAY_YYYY_MM_DD)
+        today_date = self.setup_instance(state='stopped', terminate_after=clock.today_yyyy_mm_dd)
 
-        today_warning_str = ' (Nagbot: Warned on ' + nagbot.TODAY_YYYY_MM_DD + ')'
+        today_warning_str = ' (Nagbot: Warned on ' + clock.today_yyyy_mm_dd + ')'
         past_date_warned = self.setup_instance(state='stopped', terminate_after='2019-01-01' + today_warning_str)
-        today_date_warned = self.setup_instance(state='stopped', terminate_after=nagbot.TODAY_YYYY_MM_DD + today_warning_str)
+        today_date_warned = self.setup_instance(state='stopped', terminate_after=clock.today_yyyy_mm_dd + today_warning_str)
         anything_warned = self.setup_instance(state='stopped', terminate_after='Yummy Udon Noodles' + today_warning_str)
 
-        old_warning_str = ' (Nagbot: Warned on ' + nagbot.MIN_TERMINATION_WARNING_YYYY_MM_DD + ')'
+        old_warning_str = ' (Nagbot: Warned on ' + clock.days_ago(nagbot.TERMINATION_WARNING_DAYS).isoformat() + ')'
         past_date_warned_days_ago = self.setup_instance(state='stopped', terminate_after='2019-01-01' + old_warning_str)
         anything_warned_days_ago = self.setup_instance(state='stopped', terminate_after='Yummy Udon Noodles' + old_warning_str)
 
@@ -81,36 +96,259 @@ class TestNagbot(unittest.TestCase):
         unknown_date = self.setup_instance(state='stopped', terminate_after='TBD')
 
         # These instances should get a termination warning
-        assert nagbot.is_terminatable(past_date) == True
-        assert nagbot.is_terminatable(today_date) == True
-        assert nagbot.is_terminatable(past_date_warned) == True
-        assert nagbot.is_terminatable(today_date_warned) == True
+        assert nagbot.is_terminatable(past_date, clock) == True
+        assert nagbot.is_terminatable(today_date, clock) == True
+        assert nagbot.is_terminatable(past_date_warned, clock) == True
+        assert nagbot.is_terminatable(today_date_warned, clock) == True
 
         # These instances should NOT get a termination warning
-        assert nagbot.is_terminatable(wrong_state) == False
-        assert nagbot.is_terminatable(future_date) == False
-        assert nagbot.is_terminatable(unknown_date) == False
-        assert nagbot.is_terminatable(anything_warned) == False
+        assert nagbot.is_terminatable(wrong_state, clock) == False
+        assert nagbot.is_terminatable(future_date, clock) == False
+        assert nagbot.is_terminatable(unknown_date, clock) == False
+        assert nagbot.is_terminatable(anything_warned, clock) == False
 
         # These instances don't have a warning, so they shouldn't be terminated yet
-        assert nagbot.is_safe_to_terminate(past_date) == False
-        assert nagbot.is_safe_to_terminate(today_date) == False
-        assert nagbot.is_safe_to_terminate(unknown_date) == False
-        assert nagbot.is_safe_to_terminate(wrong_state) == False
-        assert nagbot.is_safe_to_terminate(future_date) == False
-        assert nagbot.is_safe_to_terminate(anything_warned) == False
+        assert nagbot.is_safe_to_terminate(past_date, clock) == False
+        assert nagbot.is_safe_to_terminate(today_date, clock) == False
+        assert nagbot.is_safe_to_terminate(unknown_date, clock) == False
+        assert nagbot.is_safe_to_terminate(wrong_state, clock) == False
+        assert nagbot.is_safe_to_terminate(future_date, clock) == False
+        assert nagbot.is_safe_to_terminate(anything_warned, clock) == False
 
         # These instances can be terminated, but not yet
-        assert nagbot.is_safe_to_terminate(past_date_warned) == False
-        assert nagbot.is_safe_to_terminate(today_date_warned) == False
+        assert nagbot.is_safe_to_terminate(past_date_warned, clock) == False
+        assert nagbot.is_safe_to_terminate(today_date_warned, clock) == False
 
         # These instances have a warning, but are not eligible to add a warning, so we don't terminate
-        assert nagbot.is_safe_to_terminate(anything_warned_days_ago) == False
+        assert nagbot.is_safe_to_terminate(anything_warned_days_ago, clock) == False
 
         # These instances can be terminated now
-        assert nagbot.is_safe_to_terminate(past_date_warned_days_ago) == True
+        assert nagbot.is_safe_to_terminate(past_date_warned_days_ago, clock) == True
+
+
+    def test_whitelisted(self):
+        instance = self.setup_instance(state='running')
+        assert nagbot.is_whitelisted(instance) == False
+
+        instance.name = 'bam::agent-12-bamboo'
+        assert nagbot.is_whitelisted(instance) == True
+
+        instance.name = 'bam::agent-12-bamboo-old'
+        assert nagbot.is_whitelisted(instance) == False
+
+
+    def test_make_instance_summary(self):
+        instance = self.setup_instance(state='running')
+        url = 'https://us-east-1.console.aws.amazon.com/ec2/v2/home?region=us-east-1#Instances:search=abc123'
+
+        assert nagbot.make_instance_summary(instance) == '<' + url + '|Stephen>, State=running, Type=m4.xlarge'
+
+        instance.reason = 'User initiated'
+        assert nagbot.make_instance_summary(instance) \
+               == '<' + url + '|Stephen>, State=(running, "User initiated"), Type=m4.xlarge'
+
+
+    @patch('app.gdocs.get_sheet')
+    @patch('app.gdocs.pygsheets')
+    def test_write_instances_to_spreadsheet(self, mock_pygsheets, mock_get_sheet):
+        instances = [self.setup_instance(state='running') for _ in range(3)]
+        instances[0].name, instances[0].monthly_price = 'b', 1
+        instances[1].name, instances[1].monthly_price = 'c', 5
+        instances[2].name, instances[2].monthly_price = 'a', 1
+
+        nagbot.write_instances_to_spreadsheet(instances)
+
+        # Header first, then the most expensive instances, then by name. Every row is a list, as pygsheets requires.
+        values = mock_get_sheet.return_value.add_worksheet.return_value.update_values.call_args.kwargs['values']
+        assert values[1] == list(Instance.to_header(instances[0]))
+        assert [row[1] for row in values[2:]] == ['c', 'a', 'b']
+        assert all(type(row) is list for row in values)
+
+
+    @patch('app.nagbot.SLACK_EMAIL_INDEX_MIN_CONTACTS', 1)
+    @patch('app.nagbot.sqslack.build_email_index')
+    def test_lookup_contacts(self, mock_build_email_index):
+        mock_build_email_index.return_value = {'stephen.rosenthal@seeq.com': '<@UJ0JNCX19>'}
+        instances = [self.setup_instance(state='running') for _ in range(3)]
+        instances[0].contact = 'Stephen.Rosenthal@seeq.com'
+        instances[2].contact = 'someone.else'
+
+        contacts = nagbot.lookup_contacts(instances)
+
+        # Emails match regardless of case, and unknown contacts are left as-is
+        assert contacts == {'Stephen.Rosenthal@seeq.com': '<@UJ0JNCX19>', 'stephen': 'stephen',
+                            'someone.else': 'someone.else'}
+        mock_build_email_index.assert_called_once_with()
+
+
+    @patch('app.nagbot.sqslack.lookup_user_by_email')
+    @patch('app.nagbot.sqslack.build_email_index')
+    def test_lookup_contacts_few(self, mock_build_email_index, mock_lookup_user_by_email):
+        mock_lookup_user_by_email.side_effect = lambda email: '<@' + email.upper() + '>'
+        instances = [self.setup_instance(state='running') for _ in range(3)]
+        instances[2].contact = 'someone.else'
+
+        contacts = nagbot.lookup_contacts(instances)
+
+        # With only a few contacts, look them up one at a time rather than listing every Slack user
+        assert contacts == {'stephen': '<@STEPHEN>', 'someone.else': '<@SOMEONE.ELSE>'}
+        mock_build_email_index.assert_not_called()
+
+
+    @patch('app.nagbot.SLACK_EMAIL_INDEX_MIN_CONTACTS', 1)
+    @patch('app.nagbot.sqslack.lookup_user_by_email')
+    @patch('app.nagbot.sqslack.build_email_index')
+    def test_lookup_contacts_fallback(self, mock_build_email_index, mock_lookup_user_by_email):
+        mock_build_email_index.side_effect = RuntimeError('missing_scope')
+        mock_lookup_user_by_email.side_effect = lambda email: '<@' + email.upper() + '>'
+        instances = [self.setup_instance(state='running') for _ in range(3)]
+        instances[2].contact = 'someone.else'
+
+        contacts = nagbot.lookup_contacts(instances)
+
+        # Each contact is only looked up once
+        assert contacts == {'stephen': '<@STEPHEN>', 'someone.else': '<@SOMEONE.ELSE>'}
+        assert mock_lookup_user_by_email.call_count == 2
+
+
+    @patch('app.nagbot.gdocs')
+    @patch('app.nagbot.sqslack')
+    @patch('app.nagbot.sqaws')
+    def test_notify(self, mock_sqaws, mock_sqslack, mock_gdocs):
+        clock = Clock.now()
+        to_terminate = self.setup_instance(state='stopped', terminate_after='2019-01-01')
+        to_stop = self.setup_instance(state='running', stop_after='2019-01-01')
+        to_keep = self.setup_instance(state='running', stop_after='2050-01-01')
+        whitelisted = self.setup_instance(state='running', stop_after='2019-01-01')
+        whitelisted.name = 'bam::agent-bamboo'
+        mock_sqaws.list_ec2_instances.return_value = [to_terminate, to_stop, to_keep, whitelisted]
+        mock_sqslack.lookup_user_by_email.return_value = '<@UJ0JNCX19>'
+        mock_gdocs.write_to_spreadsheet.return_value = 'https://docs.google.com/spreadsheets'
+
+        nagbot.Nagbot().notify_internal('#nagbot')
+
+        warning = ' (Nagbot: Warned on ' + clock.today_yyyy_mm_dd + ')'
+        mock_sqaws.set_tags.assert_called_once_with([
+            ('us-east-1', 'abc123', 'Terminate after', '2019-01-01' + warning),
+            ('us-east-1', 'abc123', 'Stop after', '2019-01-01' + warning)])
+
+        messages = [args[1] for args, kw in mock_sqslack.send_message.call_args_list]
+        assert len(messages) == 3
+        assert 'We have 3 running EC2 instances right now and 4 total.' in messages[0]
+        assert 'it would cost $4.00' in messages[0]
+        assert 'https://docs.google.com/spreadsheets' in messages[0]
+        assert messages[1].startswith('The following 1 _stopped_ instances are due to be *TERMINATED*')
+        assert messages[2].startswith('The following 1 _running_ instances are due to be *STOPPED*')
+
+
+    @patch('app.nagbot.gdocs')
+    @patch('app.nagbot.sqslack')
+    @patch('app.nagbot.sqaws')
+    def test_notify_nothing_to_do(self, mock_sqaws, mock_sqslack, mock_gdocs):
+        mock_sqaws.list_ec2_instances.return_value = [self.setup_instance(state='running', stop_after='2050-01-01')]
+        mock_gdocs.write_to_spreadsheet.return_value = 'https://docs.google.com/spreadsheets'
+
+        nagbot.Nagbot().notify_internal('#nagbot')
+
+        # The summary, then a single "all clear" message
+        messages = [args[1] for args, kw in mock_sqslack.send_message.call_args_list]
+        assert len(messages) == 2
+        assert messages[1] == 'No instances are due to be stopped or terminated at this time.\n'
+        mock_sqaws.set_tags.assert_called_once_with([])
+
+
+    @patch('app.nagbot.gdocs')
+    @patch('app.nagbot.sqslack')
+    @patch('app.nagbot.sqaws')
+    def test_notify_spreadsheet_failure(self, mock_sqaws, mock_sqslack, mock_gdocs):
+        mock_sqaws.list_ec2_instances.return_value = [self.setup_instance(state='running', stop_after='2050-01-01')]
+        mock_gdocs.write_to_spreadsheet.side_effect = RuntimeError('Quota exceeded')
+
+        nagbot.Nagbot().notify_internal('#nagbot')
+
+        # The summary is still posted, just without a link to the spreadsheet
+        summary = mock_sqslack.send_message.call_args_list[0][0][1]
+        assert 'We have 1 running EC2 instances right now and 1 total.' in summary
+        assert 'spreadsheet' not in summary
+
+
+    @patch('app.nagbot.sqslack')
+    @patch('app.nagbot.sqaws')
+    def test_execute(self, mock_sqaws, mock_sqslack):
+        clock = Clock.now()
+        warned_days_ago = ' (Nagbot: Warned on ' + clock.days_ago(nagbot.TERMINATION_WARNING_DAYS).isoformat() + ')'
+        to_terminate = self.setup_instance(state='stopped', terminate_after='2019-01-01' + warned_days_ago)
+        to_stop = self.setup_instance(state='running', stop_after='2019-01-01' + warned_days_ago)
+        to_keep = self.setup_instance(state='running', stop_after='2050-01-01')
+        mock_sqaws.list_ec2_instances.return_value = [to_terminate, to_stop, to_keep]
+        mock_sqslack.lookup_user_by_email.return_value = '<@UJ0JNCX19>'
+
+        nagbot.Nagbot().execute_internal('#nagbot')
+
+        mock_sqaws.list_ec2_instances.assert_called_once_with(actionable_only=True)
+        mock_sqaws.terminate_instance.assert_called_once_with('us-east-1', 'abc123')
+        mock_sqaws.stop_instance.assert_called_once_with('us-east-1', 'abc123')
+        mock_sqaws.set_tags.assert_called_once_with(
+            [('us-east-1', 'abc123', 'Nagbot State', 'Stopped on ' + clock.today_yyyy_mm_dd)])
+
+        # Terminations and stops are reported together, terminations first
+        mock_sqslack.send_message.assert_called_once()
+        message = mock_sqslack.send_message.call_args[0][1]
+        assert message.startswith('I terminated the following instances: ')
+        assert '\nI stopped the following instances: ' in message
+
+
+    @patch('app.nagbot.sqslack')
+    @patch('app.nagbot.sqaws')
+    def test_execute_tagging_failure(self, mock_sqaws, mock_sqslack):
+        clock = Clock.now()
+        warned_days_ago = ' (Nagbot: Warned on ' + clock.days_ago(nagbot.TERMINATION_WARNING_DAYS).isoformat() + ')'
+        to_terminate = self.setup_instance(state='stopped', terminate_after='2019-01-01' + warned_days_ago)
+        to_stop = self.setup_instance(state='running', stop_after='2019-01-01' + warned_days_ago)
+        mock_sqaws.list_ec2_instances.return_value = [to_terminate, to_stop]
+        mock_sqaws.set_tags.side_effect = Exception('RequestLimitExceeded')
+
+        nagbot.Nagbot().execute_internal('#nagbot')
+
+        # The actions still happen, and are still reported along with the failure
+        mock_sqaws.terminate_instance.assert_called_once_with('us-east-1', 'abc123')
+        mock_sqaws.stop_instance.assert_called_once_with('us-east-1', 'abc123')
+        mock_sqslack.send_message.assert_called_once()
+        message = mock_sqslack.send_message.call_args[0][1]
+        assert message.startswith('I terminated the following instances: ')
+        assert '\nI stopped the following instances: ' in message
+        assert message.endswith('Failed to tag the stopped instances: RequestLimitExceeded\n')
+
+
+    @patch('app.nagbot.sqslack')
+    @patch('app.nagbot.sqaws')
+    def test_execute_stop_failure(self, mock_sqaws, mock_sqslack):
+        clock = Clock.now()
+        warned_days_ago = ' (Nagbot: Warned on ' + clock.days_ago(nagbot.TERMINATION_WARNING_DAYS).isoformat() + ')'
+        to_terminate = self.setup_instance(state='stopped', terminate_after='2019-01-01' + warned_days_ago)
+        to_stop = self.setup_instance(state='running', stop_after='2019-01-01' + warned_days_ago)
+        mock_sqaws.list_ec2_instances.return_value = [to_terminate, to_stop]
+        mock_sqaws.stop_instance.side_effect = Exception('UnauthorizedOperation')
+
+        with self.assertRaises(Exception):
+            nagbot.Nagbot().execute_internal('#nagbot')
+
+        # The terminations are still reported before the failure is raised
+        mock_sqslack.send_message.assert_called_once()
+        assert mock_sqslack.send_message.call_args[0][1].startswith('I terminated the following instances: ')
+
+
+    @patch('app.nagbot.sqslack')
+    @patch('app.nagbot.sqaws')
+    def test_execute_nothing_to_do(self, mock_sqaws, mock_sqslack):
+        mock_sqaws.list_ec2_instances.return_value = [self.setup_instance(state='running', stop_after='2050-01-01')]
 
+        nagbot.Nagbot().execute_internal('#nagbot')
 
+        mock_sqaws.terminate_instance.assert_not_called()
+        mock_sqaws.stop_instance.assert_not_called()
+        mock_sqslack.send_message.assert_called_once_with(
+            '#nagbot', 'No instances were terminated today.\nNo instances were stopped today.\n')
 
 
 if __name__ == '__main__':
@@ -1,6 +1,6 @@
 import sys
 import unittest
-from datetime import datetime
+from datetime import date
 
 import app
 from app import parsing
@@ -49,16 +49,43 @@ class TestParsing(unittest.TestCase):
         assert roundtrip(None) == None
 
 
+    def test_parse_yyyy_mm_dd(self):
+        # ISO-8601 dates are parsed
+        assert parsing.parse_yyyy_mm_dd('2019-01-01') == date(2019, 1, 1)
+        assert parsing.parse_yyyy_mm_dd('2019-12-31') == date(2019, 12, 31)
+
+        # Other formats are meaningful, but not supported by the parser
+        assert parsing.parse_yyyy_mm_dd('2019-1-2') is None
+        assert parsing.parse_yyyy_mm_dd('2019/01/02') is None
+        assert parsing.parse_yyyy_mm_dd('01/02/2019') is None
+        assert parsing.parse_yyyy_mm_dd('January 2, 2019') is None
+
+        # Format OK but no such month or day, so doesn't parse
+        assert parsing.parse_yyyy_mm_dd('9999-99-99') is None
+        assert parsing.parse_yyyy_mm_dd('2019-02-31') is None
+        assert parsing.parse_yyyy_mm_dd('2019-11-31') is None
+
+        # Format not OK
+        assert parsing.parse_yyyy_mm_dd('abc') is None
+        assert parsing.parse_yyyy_mm_dd('') is None
+        assert parsing.parse_yyyy_mm_dd('2019-01-01 ') is None
+
+
+    def test_yyyy_mm_dd_roundtrip(self):
+        assert parsing.parse_yyyy_mm_dd('2019-01-01').isoformat() == '2019-01-01'
+        assert parsing.parse_yyyy_mm_dd('2019-12-31').isoformat() == '2019-12-31'
+
+
     def test_parse_date_tag(self):
         parsed = parsing.parse_date_tag('2019-01-01')
-        assert parsed.expiry_date == '2019-01-01'
+        assert parsed.expiry_date == date(2019, 1, 1)
         assert parsed.on_weekends == False
         assert parsed.warning_date == None
 
         parsed = parsing.parse_date_tag('2019-01-01 (Nagbot: Warned on 2019-02-01)')
-        assert parsed.expiry_date == '2019-01-01'
+        assert parsed.expiry_date == date(2019, 1, 1)
         assert parsed.on_weekends == False
-        assert parsed.warning_date == '2019-02-01'
+        assert parsed.warning_date == date(2019, 2, 1)
 
         parsed = parsing.parse_date_tag('On Weekends')
         assert parsed.expiry_date == None
@@ -73,17 +100,23 @@ class TestParsing(unittest.TestCase):
         parsed = parsing.parse_date_tag('On Weekends (Nagbot: Warned on 2019-02-01)')
         assert parsed.expiry_date == None
         assert parsed.on_weekends == True
-        assert parsed.warning_date == '2019-02-01'
+        assert parsed.warning_date == date(2019, 2, 1)
 
         parsed = parsing.parse_date_tag(' (Nagbot: Warned on 2019-02-01)')
         assert parsed.expiry_date == None
         assert parsed.on_weekends == False
-        assert parsed.warning_date == '2019-02-01'
+        assert parsed.warning_date == date(2019, 2, 1)
 
         parsed = parsing.parse_date_tag('(Nagbot: Warned on 2019-02-01)')
         assert parsed.expiry_date == None
         assert parsed.on_weekends == False
-        assert parsed.warning_date == '2019-02-01'
+        assert parsed.warning_date == date(2019, 2, 1)
+
+        # Dates that look right but don't exist, and warnings that aren't at the end, are ignored
+        parsed = parsing.parse_date_tag('2019-02-31 (Nagbot: Warned on 2019-02-01) later')
+        assert parsed.expiry_date == None
+        assert parsed.on_weekends == False
+        assert parsed.warning_date == None
 
 
     def test_print_date_tag(self):
@@ -102,16 +135,29 @@ class TestParsing(unittest.TestCase):
 
     def test_add_warning_to_tag(self):
         # Tags that we can't understand will be clobbered, just to keep it simple
-        assert parsing.add_warning_to_tag('TBD', '2019-12-31') == ' (Nagbot: Warned on 2019-12-31)'
-        assert parsing.add_warning_to_tag('I dunno', '2019-12-31') == ' (Nagbot: Warned on 2019-12-31)'
+        assert parsing.add_warning_to_tag('TBD', date(2019, 12, 31)) == ' (Nagbot: Warned on 2019-12-31)'
+        assert parsing.add_warning_to_tag('I dunno', date(2019, 12, 31)) == ' (Nagbot: Warned on 2019-12-31)'
 
         # Stop/Terminate after dates will be preserved, but a warning will be added
-        assert parsing.add_warning_to_tag('2019-12-01', '2019-12-31') == '2019-12-01 (Nagbot: Warned on 2019-12-31)'
+        assert parsing.add_warning_to_tag('2019-12-01', date(2019, 12, 31)) == '2019-12-01 (Nagbot: Warned on 2019-12-31)'
 
         # Existing warnings will be unmodified
-        assert parsing.add_warning_to_tag('2019-12-01 (Nagbot: Warned on 2019-12-15)', '2019-12-31') \
+        assert parsing.add_warning_to_tag('2019-12-01 (Nagbot: Warned on 2019-12-15)', date(2019, 12, 31)) \
                == '2019-12-01 (Nagbot: Warned on 2019-12-15)'
 
+        # ...unless they are being replaced
+        assert parsing.add_warning_to_tag('2019-12-01 (Nagbot: Warned on 2019-12-15)', date(2019, 12, 31), replace=True) \
+               == '2019-12-01 (Nagbot: Warned on 2019-12-31)'
+
+    def test_parse_date_tag_is_cached(self):
+        parsed = parsing.parse_date_tag('2019-12-01')
+        assert parsing.parse_date_tag('2019-12-01') is parsed
+
+        # Adding a warning must not modify the cached result
+        assert parsing.add_warning_to_tag('2019-12-01', date(2019, 12, 31)) == '2019-12-01 (Nagbot: Warned on 2019-12-31)'
+        assert parsed.warning_date is None
+        assert str(parsing.parse_date_tag('2019-12-01')) == '2019-12-01'
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -1,39 +1,184 @@
 import sys
+import tempfile
+import threading
+import time
 import unittest
-from unittest.mock import patch
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock, call, patch
 
 import app.sqaws
 
 
 class TestAws(unittest.TestCase):
-    def test_make_tags_dict(self):
+    def setUp(self):
+        app.sqaws.create_ec2_client.cache_clear()
+
+
+    def test_extract_known_tags(self):
         tags_list = [{'Key': 'Contact', 'Value': 'stephen.rosenthal@seeq.com'},
                      {'Key': 'Stop after', 'Value': '2020-01-01'},
-                     {'Key': 'Terminate after', 'Value': '2021-01-01'},
+                     {'Key': 'TerminateAfter', 'Value': '2021-01-01'},
+                     {'Key': 'Team', 'Value': 'Infrastructure'},
                      {'Key': 'Name', 'Value': 'super-cool-server.seeq.com'}]
 
-        tags_dict = app.sqaws.make_tags_dict(tags_list)
+        tags_dict = app.sqaws.extract_known_tags(tags_list)
 
         assert tags_dict == {'Contact': 'stephen.rosenthal@seeq.com',
                              'Stop after': '2020-01-01',
-                             'Terminate after': '2021-01-01',
+                             'TerminateAfter': '2021-01-01',
                              'Name': 'super-cool-server.seeq.com'}
 
+    def test_get_tag(self):
+        tags = {'Stop After': '2020-01-01', 'StopAfter': '2021-01-01'}
+
+        assert app.sqaws.get_tag(tags, 'Stop after', 'Stop After', 'StopAfter') == '2020-01-01'
+        assert app.sqaws.get_tag(tags, 'StopAfter') == '2021-01-01'
+        assert app.sqaws.get_tag(tags, 'Terminate after', 'Terminate After', 'TerminateAfter') == ''
+
+    @patch('app.sqaws.awspricing.offer')
+    def test_lookup_monthly_price(self, mock_offer):
+        app.sqaws.get_ec2_offer.cache_clear()
+        app.sqaws.lookup_monthly_price.cache_clear()
+        mock_offer.return_value.ondemand_hourly.return_value = 0.5
+
+        assert app.sqaws.lookup_monthly_price('us-east-1', 'm4.xlarge', 'Linux') == 365
+        assert app.sqaws.lookup_monthly_price('us-east-1', 'm4.xlarge', 'Linux') == 365
+        assert app.sqaws.lookup_monthly_price('us-west-2', 'm4.xlarge', 'Linux') == 365
+
+        # The price list is only loaded once, and each distinct instance type is only priced once
+        mock_offer.assert_called_once_with('AmazonEC2')
+        assert mock_offer.return_value.ondemand_hourly.call_count == 2
+
+
     @patch('app.sqaws.boto3.client')
-    def test_set_tag(self, mock_client):
-        region_name = 'us-east-1'
-        instance_id = 'i-0f06b49c1f16dcfde'
-        tag_name = 'Stop after'
-        tag_value = '2019-12-25'
+    def test_get_region_names(self, mock_client):
+        mock_ec2 = mock_client.return_value
+        mock_ec2.describe_regions.return_value = {'Regions': [{'RegionName': 'us-east-1'},
+                                                              {'RegionName': 'us-west-2'}]}
+
+        assert app.sqaws.get_region_names() == ('us-east-1', 'us-west-2')
+
+        mock_ec2.describe_regions.assert_called_once_with()
+
+
+    @patch('app.sqaws.get_ec2_offer')
+    @patch('app.sqaws.get_region_names')
+    @patch('app.sqaws.get_ebs_volume_sizes')
+    @patch('app.sqaws.build_instance_model')
+    @patch('app.sqaws.boto3.client')
+    def test_list_ec2_instances(self, mock_client, mock_build_instance_model, mock_get_ebs_volume_sizes,
+                                mock_get_region_names, mock_get_ec2_offer):
         mock_ec2 = mock_client.return_value
+        mock_get_region_names.return_value = ('us-east-1', 'us-west-2')
+        mock_paginator = mock_ec2.get_paginator.return_value
+        mock_paginator.paginate.side_effect = lambda **kw: [{'Reservations': [{'Instances': [{'InstanceId': 'i-1'}]}]},
+                                                            {'Reservations': [{'Instances': [{'InstanceId': 'i-2'}]}]}]
+        build_threads = set()
+        def build_instance_model(region_name, instance_dict, volume_sizes):
+            build_threads.add(threading.current_thread())
+            return region_name, instance_dict['InstanceId']
+        mock_build_instance_model.side_effect = build_instance_model
+
+        instances = app.sqaws.list_ec2_instances()
+
+        # Every region is queried, and the results keep the order of the regions
+        assert instances == [('us-east-1', 'i-1'), ('us-east-1', 'i-2'),
+                             ('us-west-2', 'i-1'), ('us-west-2', 'i-2')]
+        assert mock_client.call_count == 2
+        # The price list is loaded, and the models (which look up prices) are built, outside the worker threads
+        mock_get_ec2_offer.assert_called_once_with()
+        assert build_threads == {threading.main_thread()}
+        mock_ec2.get_paginator.assert_called_with('describe_instances')
+        assert mock_paginator.paginate.call_count == 2
+        assert mock_get_ebs_volume_sizes.call_count == 2
+        assert mock_paginator.paginate.call_args.kwargs['Filters'] == [
+            {'Name': 'instance-state-name', 'Values': ['pending', 'running', 'stopping', 'stopped']}]
+
+        # Only instances that could be stopped or terminated are listed for 'execute'
+        app.sqaws.list_ec2_instances(actionable_only=True)
+        assert mock_paginator.paginate.call_args.kwargs['Filters'] == [
+            {'Name': 'instance-state-name', 'Values': ['running', 'stopped']},
+            {'Name': 'tag-key', 'Values': ['Stop after', 'Stop After', 'StopAfter',
+                                           'Terminate after', 'Terminate After', 'TerminateAfter']}]
+
+
+    @patch('app.sqaws.get_ec2_offer')
+    @patch('app.sqaws.get_region_names')
+    def test_list_ec2_instances_no_regions(self, mock_get_region_names, mock_get_ec2_offer):
+        mock_get_region_names.return_value = ()
+
+        assert app.sqaws.list_ec2_instances() == []
+
+
+    @patch('app.sqaws.list_ec2_instances')
+    def test_list_ec2_instances_cached(self, mock_list_ec2_instances):
+        with tempfile.TemporaryDirectory() as cache_dir, patch('app.sqaws.CACHE_DIR', cache_dir):
+            mock_list_ec2_instances.return_value = ['first']
+            assert app.sqaws.list_ec2_instances_cached(60) == ['first']
+
+            # A recent enough result is reused
+            mock_list_ec2_instances.return_value = ['second']
+            assert app.sqaws.list_ec2_instances_cached(60) == ['first']
+            assert mock_list_ec2_instances.call_count == 1
+
+            # A result that's too old is not
+            assert app.sqaws.list_ec2_instances_cached(0) == ['second']
+            assert mock_list_ec2_instances.call_count == 2
+
+
+    def test_get_ebs_volume_sizes(self):
+        mock_ec2 = MagicMock()
+        mock_ec2.get_paginator.return_value.paginate.return_value = [
+            {'Volumes': [{'Size': 8, 'Attachments': [{'InstanceId': 'i-1'}]},
+                         {'Size': 100, 'Attachments': [{'InstanceId': 'i-1'}]}]},
+            {'Volumes': [{'Size': 20, 'Attachments': [{'InstanceId': 'i-2'}]},
+                         {'Size': 500, 'Attachments': []}]}]
+
+        volume_sizes = app.sqaws.get_ebs_volume_sizes(mock_ec2)
+
+        assert volume_sizes == {'i-1': 108, 'i-2': 20}
+        mock_ec2.get_paginator.assert_called_once_with('describe_volumes')
+
+
+    @patch('app.sqaws.boto3.client')
+    def test_get_ec2_client_from_many_threads(self, mock_client):
+        def slow_client(*args, **kw):
+            time.sleep(0.01)  # Give other threads a chance to race this one
+            return MagicMock()
+        mock_client.side_effect = slow_client
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            clients = list(executor.map(app.sqaws.get_ec2_client, ['us-east-1'] * 8))
+
+        # Only one client is created, and every thread shares it
+        mock_client.assert_called_once_with('ec2', region_name='us-east-1', config=app.sqaws.BOTO_CONFIG)
+        assert all(client is clients[0] for client in clients)
+
+
+    @patch('app.sqaws.boto3.client')
+    def test_set_tags(self, mock_client):
+        mock_ec2 = mock_client.return_value
+        many_instance_ids = ['i-%d' % n for n in range(1500)]
+        tag_updates = [('us-east-1', 'i-a', 'Stop after', '2019-12-25'),
+                       ('us-east-1', 'i-b', 'Stop after', '2019-12-25'),
+                       ('us-east-1', 'i-c', 'Stop after', '2019-12-31'),
+                       ('us-west-2', 'i-d', 'Stop after', '2019-12-25')] \
+                      + [('us-east-1', i, 'Nagbot State', 'Stopped') for i in many_instance_ids]
+
+        app.sqaws.set_tags(tag_updates)
 
-        app.sqaws.set_tag(region_name, instance_id, tag_name, tag_value)
+        # Instances in the same region with the same tag are tagged together, in chunks of 1000
+        tags = lambda name, value: [{'Key': name, 'Value': value}]
+        mock_ec2.create_tags.assert_has_calls(any_order=True, calls=[
+            call(Resources=['i-a', 'i-b'], Tags=tags('Stop after', '2019-12-25')),
+            call(Resources=['i-c'], Tags=tags('Stop after', '2019-12-31')),
+            call(Resources=['i-d'], Tags=tags('Stop after', '2019-12-25')),
+            call(Resources=many_instance_ids[:1000], Tags=tags('Nagbot State', 'Stopped')),
+            call(Resources=many_instance_ids[1000:], Tags=tags('Nagbot State', 'Stopped'))])
+        assert mock_ec2.create_tags.call_count == 5
 
-        mock_client.assert_called_once_with('ec2', region_name=region_name)
-        mock_ec2.create_tags.assert_called_once_with(Resources=[instance_id], Tags=[{
-            'Key': tag_name,
-            'Value': tag_value
-        }])
+        # Each region's client is only created once
+        assert mock_client.call_count == 2
 
 
     @patch('app.sqaws.boto3.client')
@@ -44,7 +189,7 @@ class TestAws(unittest.TestCase):
 
         assert app.sqaws.stop_instance(region_name, instance_id)
 
-        mock_client.assert_called_once_with('ec2', region_name=region_name)
+        mock_client.assert_called_once_with('ec2', region_name=region_name, config=app.sqaws.BOTO_CONFIG)
         mock_ec2.stop_instances.assert_called_once_with(InstanceIds=[instance_id])
 
 
@@ -61,7 +206,7 @@ class TestAws(unittest.TestCase):
 
         assert not app.sqaws.stop_instance(region_name, instance_id)
 
-        mock_client.assert_called_once_with('ec2', region_name=region_name)
+        mock_client.assert_called_once_with('ec2', region_name=region_name, config=app.sqaws.BOTO_CONFIG)
         mock_ec2.stop_instances.assert_called_once_with(InstanceIds=[instance_id])
 
 
@@ -73,7 +218,7 @@ class TestAws(unittest.TestCase):
 
         assert app.sqaws.terminate_instance(region_name, instance_id)
 
-        mock_client.assert_called_once_with('ec2', region_name=region_name)
+        mock_client.assert_called_once_with('ec2', region_name=region_name, config=app.sqaws.BOTO_CONFIG)
         mock_ec2.terminate_instances.assert_called_once_with(InstanceIds=[instance_id])
 
 
@@ -91,7 +236,7 @@ class TestAws(unittest.TestCase):
 
         assert not app.sqaws.terminate_instance(region_name, instance_id)
 
-        mock_client.assert_called_once_with('ec2', region_name=region_name)
+        mock_client.assert_called_once_with('ec2', region_name=region_name, config=app.sqaws.BOTO_CONFIG)
         mock_ec2.terminate_instances.assert_called_once_with(InstanceIds=[instance_id])
 
 
@@ -1,6 +1,6 @@
 import os
 import unittest
-from unittest.mock import patch
+from unittest.mock import MagicMock, call, patch
 
 import app.sqslack
 
@@ -10,6 +10,7 @@ class TestSlack(unittest.TestCase):
         token = '<not a real Slack API token>'
         os.environ['SLACK_BOT_TOKEN'] = token
         mock_slack = mock_web_client.return_value
+        app.sqslack.lookup_user_by_email.cache_clear()
         return mock_slack, token
 
 
@@ -37,6 +38,10 @@ class TestSlack(unittest.TestCase):
         mock_client.assert_called_once_with(token=token)
         mock_slack.users_lookupByEmail.assert_called_once_with(email=email)
 
+        # Looking up the same user again doesn't call Slack again
+        assert app.sqslack.lookup_user_by_email(email) == '<@UJ0JNCX19>'
+        mock_slack.users_lookupByEmail.assert_called_once_with(email=email)
+
 
     @patch('app.sqslack.slack.WebClient')
     def test_lookup_user_by_email_exception(self, mock_client):
@@ -53,5 +58,24 @@ class TestSlack(unittest.TestCase):
         mock_slack.users_lookupByEmail.assert_called_once_with(email=email)
 
 
+    @patch('app.sqslack.slack.WebClient')
+    def test_build_email_index(self, mock_client):
+        mock_slack, token = self.setup_mock_slack(mock_client)
+        first_page = MagicMock()
+        first_page.data = {'members': [{'id': 'UJ0JNCX19', 'profile': {'email': 'Stephen.Rosenthal@seeq.com'}},
+                                       {'id': 'USLACKBOT', 'profile': {}}],
+                           'response_metadata': {'next_cursor': 'abc'}}
+        last_page = MagicMock()
+        last_page.data = {'members': [{'id': 'UK1KODY20', 'profile': {'email': 'someone.else@seeq.com'}}],
+                          'response_metadata': {'next_cursor': ''}}
+        mock_slack.users_list.side_effect = [first_page, last_page]
+
+        email_index = app.sqslack.build_email_index()
+
+        assert email_index == {'stephen.rosenthal@seeq.com': '<@UJ0JNCX19>', 'someone.else@seeq.com': '<@UK1KODY20>'}
+        mock_client.assert_called_once_with(token=token)
+        assert mock_slack.users_list.call_args_list == [call(limit=200), call(limit=200, cursor='abc')]
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file